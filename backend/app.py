@@ -22,10 +22,10 @@ import traceback
 from termcolor import colored
 import mysql.connector
 from qdrant_client import QdrantClient
-from sentence_transformers import SentenceTransformer
 
 
 from src.utils.project_structure import get_project_root
+from src.embeddings import load_embedding_model
 
 
 
@@ -100,7 +100,7 @@ print_to_debug_log("Done.")
 print_to_debug_log("Loading SentenceTransformer (all-MiniLM-L6-v2)...")
 
 # Use GPU0 specifically, not any other GPU
-embedding_model = SentenceTransformer("all-MiniLM-L6-v2", device="cuda:0")
+embedding_model = load_embedding_model(device="cuda:0")  # fp16; callers normalize the output in fp32
 
 print_to_debug_log("Done.")
 
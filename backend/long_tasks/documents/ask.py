@@ -3,11 +3,14 @@ import traceback
 import math
 import random
 
+import numpy as np
 import requests
 from pydantic import BaseModel, StrictStr, ValidationError, validator
+from qdrant_client.http.models import SearchParams, QuantizationSearchParams
 from termcolor import colored
 
 from backend.api_types import FatalTaskError, AppResources, TaskContext
+from src.embeddings import normalize_rows
 
 TOP_K_SENTENCES=30
 TOP_K_PARAGRAPHS=10
@@ -94,34 +97,46 @@ def _cosine_similarity(v1, v2) -> float:
         return 0.0
     return dot / (norm1 * norm2)
 
-def search_result_to_text_block(result, app_resources: AppResources) -> str:
-    print_to_debug_log = app_resources.print_to_debug_log
-
-    sentence_metadata = result.payload
-    sentence_vector = result.vector
-
-    mysql_conn = app_resources.mysql_conn
-    qdrant_client = app_resources.qdrant_client
-
-    object_id = sentence_metadata["object_id"]
-    sentence_index = sentence_metadata["sentence_index"]
-
-    start_idx = max(0, sentence_index - MAX_PARAGRAPH_SIZE)
-    end_idx = sentence_index + MAX_PARAGRAPH_SIZE
-
-    cursor = mysql_conn.cursor(dictionary=True)
+def fetch_flood_windows(object_id: str, search_results, app_resources: AppResources) -> Dict[int, dict]:
+    """
+    Fetch the +-MAX_PARAGRAPH_SIZE sentence window around every search hit in one query.
+
+    Returns a mapping of sentence_index -> row shared by all hits. Flooding can never
+    reach further than MAX_PARAGRAPH_SIZE - 1 sentences from its seed, so the union of
+    windows behaves exactly like a per-hit window.
+    """
+    wanted = set()
+    for result in search_results:
+        sentence_index = result.payload["sentence_index"]
+        wanted.update(range(max(0, sentence_index - MAX_PARAGRAPH_SIZE), sentence_index + MAX_PARAGRAPH_SIZE + 1))
+    if not wanted:
+        return {}
+
+    placeholders = ",".join(["%s"] * len(wanted))
+    cursor = app_resources.mysql_conn.cursor(dictionary=True)
     try:
         cursor.execute(
             "SELECT sentence_index, sentence_text, vector_uuid FROM sentences "
-            "WHERE object_id=%s AND sentence_index >= %s AND sentence_index <= %s "
+            f"WHERE object_id=%s AND sentence_index IN ({placeholders}) "
             "ORDER BY sentence_index ASC",
-            (object_id, start_idx, end_idx),
+            (object_id, *sorted(wanted)),
         )
         rows = cursor.fetchall()
     finally:
         cursor.close()
 
-    idx_to_row = {row["sentence_index"]: row for row in rows}
+    return {row["sentence_index"]: row for row in rows}
+
+def search_result_to_text_block(result, app_resources: AppResources, idx_to_row: Dict[int, dict]) -> str:
+    print_to_debug_log = app_resources.print_to_debug_log
+
+    sentence_metadata = result.payload
+    sentence_vector = result.vector
+
+    qdrant_client = app_resources.qdrant_client
+
+    object_id = sentence_metadata["object_id"]
+    sentence_index = sentence_metadata["sentence_index"]
 
     up_idx = sentence_index - 1
     down_idx = sentence_index + 1
@@ -273,12 +288,14 @@ def task_ask(ctx:TaskContext,args: Dict, app_resources: AppResources) -> str:
     
     ctx.emit_update("Embedding your question...")
     
-    # Load embedding model (same as used in ingestion)
-    from sentence_transformers import SentenceTransformer
-    model = SentenceTransformer('all-MiniLM-L6-v2')
+    # Same embedding model as used in ingestion
+    model = app_resources.embedding_model
     
     # Embed the question
-    question_vector = model.encode([params.question], show_progress_bar=False)[0].tolist()
+    # The fp16 model output is cast up and normalized in fp32, as at ingest
+    question_vector = normalize_rows(
+        model.encode([params.question], show_progress_bar=False, convert_to_numpy=True).astype(np.float32)
+    )[0].tolist()
     
     ctx.emit_update("Searching for relevant content...")
     
@@ -289,7 +306,10 @@ def task_ask(ctx:TaskContext,args: Dict, app_resources: AppResources) -> str:
             query_vector=question_vector,
             limit=TOP_K_SENTENCES,
             with_payload=True,
-            with_vectors=True
+            with_vectors=True,
+            search_params=SearchParams(
+                quantization=QuantizationSearchParams(rescore=True, oversampling=2.0)
+            ),
         )
     except Exception as e:
         raise FatalTaskError("Vector search error", {"status": 500, "error": str(e)})
@@ -305,11 +325,16 @@ def task_ask(ctx:TaskContext,args: Dict, app_resources: AppResources) -> str:
 
     found_text_blocks = []
 
+    try:
+        idx_to_row = fetch_flood_windows(processed_object_id, search_results, app_resources)
+    except Exception as e:
+        raise FatalTaskError("Database error", {"status": 500, "error": str(e)})
+
     for i,search_result in enumerate(search_results):
         print_to_debug_log(f"Found document with id '{search_result.id}' and score '{search_result.score}'")
 
         found_text_blocks.append(
-            search_result_to_text_block(search_result, app_resources)
+            search_result_to_text_block(search_result, app_resources, idx_to_row)
         )
 
         ctx.emit_progress(
@@ -2,16 +2,31 @@
 
 from typing import Dict, List
 import os
-import uuid
 
+import numpy as np
 import pysbd
 from pydantic import BaseModel, StrictStr, ValidationError, validator
-from qdrant_client.http.models import Distance, VectorParams, PointStruct
+from qdrant_client.http.models import (
+    Distance,
+    VectorParams,
+    PointStruct,
+    ScalarQuantization,
+    ScalarQuantizationConfig,
+    ScalarType,
+)
 
 from backend.api_types import TaskContext, AppResources, FatalTaskError
+from src.embeddings import normalize_rows
+from src.utils.ids import random_uuids
 
 
 QDRANT_UPLOAD_BATCH_SIZE = 128
+EMBED_BATCH_SIZE = 256
+
+# int8 vectors kept in RAM for search, original float32 vectors on disk for rescoring
+QDRANT_QUANTIZATION_CONFIG = ScalarQuantization(
+    scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=0.99, always_ram=True)
+)
 
 
 class IngestSentencesParams(BaseModel):
@@ -88,7 +103,14 @@ def task_ingest_sentences(
     num_embedded_sentences = len(embed_sentences)
     total_line_count = len(sentences)
 
-    embeddings = model.encode(embed_sentences, show_progress_bar=False)
+    # The shared model may run in fp16; normalize the final vectors in fp32
+    embeddings = model.encode(
+        embed_sentences,
+        batch_size=EMBED_BATCH_SIZE,
+        show_progress_bar=False,
+        convert_to_numpy=True,
+    ).astype(np.float32)
+    normalize_rows(embeddings)
 
     # Reset any existing data for this object
     cursor = mysql_conn.cursor()
@@ -103,18 +125,22 @@ def task_ingest_sentences(
         qdrant_client.delete_collection(collection_name=processed_object_id)
     qdrant_client.create_collection(
         collection_name=processed_object_id,
-        vectors_config=VectorParams(size=len(embeddings[0]), distance=Distance.COSINE),
+        vectors_config=VectorParams(
+            size=len(embeddings[0]), distance=Distance.COSINE, on_disk=True
+        ),
+        quantization_config=QDRANT_QUANTIZATION_CONFIG,
     )
 
     ctx.emit_progress(0, total_line_count)
 
     embed_iter = iter(embeddings)
+    id_iter = iter(random_uuids(len(embeddings)))
     points: List[PointStruct] = []
     cursor = mysql_conn.cursor()
     sentence_idx = 0
     try:
         for sent in sentences:
-            vector_id = str(uuid.uuid4()) if sent else None
+            vector_id = next(id_iter) if sent else None
             cursor.execute(
                 "INSERT INTO sentences (object_id, sentence_index, sentence_text, vector_uuid) VALUES (%s, %s, %s, %s)",
                 (processed_object_id, sentence_idx, sent, vector_id),
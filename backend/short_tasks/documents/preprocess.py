@@ -14,6 +14,7 @@ EXOTIC_WHITESPACE = {
     "\u000B": "LINE TABULATION",
     "\u00A0": "NO-BREAK SPACE",
 }
+MULTI_NEWLINE = re.compile(r"\n{3,}")
 
 
 class PreprocessParams(BaseModel):
@@ -54,7 +55,7 @@ def _clean_text(text: str) -> str:
     cleaned = "\n".join(trimmed_lines)
 
     # Step 7: Condense runs of >2 newlines to exactly two
-    cleaned = re.sub(r"\n{3,}", "\n\n", cleaned)
+    cleaned = MULTI_NEWLINE.sub("\n\n", cleaned)
 
     return cleaned
 
@@ -18,13 +18,14 @@ tokenizer = AutoTokenizer.from_pretrained(MODEL)
 tokenizer.pad_token_id = tokenizer.eos_token_id
 
 def count_conversation_tokens(messages):
+    # Template and tokenize in one pass straight to a list of ids (no tensor round-trip)
+    # return_dict keeps the return type fixed across transformers versions
     tokens=tokenizer.apply_chat_template(
             messages,
+            tokenize=True,
             add_generation_prompt=True,
             return_dict=True,
-            return_tensors="pt",
-    )["input_ids"].squeeze().tolist()
-
+    )["input_ids"]
 
     num_tokens = len(tokens)
 
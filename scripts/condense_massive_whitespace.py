@@ -26,6 +26,8 @@ import sys
 import re
 import click
 
+_RE_THREE_NEWLINES = re.compile(r'\n{3,}')
+
 @click.command()
 @click.argument(
     'input_path',
@@ -75,7 +77,7 @@ def main(input_path, output_path, yes):
     combined = '\n'.join(processed_lines)
 
     # Collapse three or more newlines into two
-    collapsed = re.sub(r'\n{3,}', '\n\n', combined).strip()
+    collapsed = _RE_THREE_NEWLINES.sub('\n\n', combined).strip()
 
     # Write result
     with open(out_path, 'w', encoding='utf-8', newline='\n') as out:
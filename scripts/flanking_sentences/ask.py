@@ -2,13 +2,16 @@ import argparse
 import os
 import re
 import mysql.connector
+import mysql.connector.pooling
+import numpy as np
 from collections import Counter
 from qdrant_client import QdrantClient
-from sentence_transformers import SentenceTransformer
+from qdrant_client.http.models import SearchParams, QuantizationSearchParams
 from dotenv import dotenv_values
 from termcolor import colored
 
-from src.mistral import Mistral, OutOfMemoryError, OutOfTokensError, UnfinishedResponseError
+from src.embeddings import load_embedding_model
+from src.mistral import Mistral
 
 # Load environment variables
 mysql_env = dotenv_values(os.path.join(
@@ -22,25 +25,64 @@ mistral = Mistral(quantization='8bit', device_ids=None)  # Use all available dev
 
 mistral.report_memory_usage()
 
+MYSQL_POOL_SIZE = 4
+
+# Lazily created, process-wide clients (see get_mysql_connection / get_qdrant_client)
+_mysql_pool = None
+_qdrant_client = None
+
+
 def get_mysql_connection():
-    return mysql.connector.connect(
-        host=mysql_env.get("MYSQL_HOST", "localhost"),
-        port=int(mysql_env.get("MYSQL_PORT", 3306)),
-        user=mysql_env["MYSQL_USER"],
-        password=mysql_env["MYSQL_PASSWORD"],
-        database=mysql_env["MYSQL_DATABASE"],
-        charset="utf8mb4"
-    )
+    """Borrow a connection from the shared pool; closing it returns it to the pool."""
+    global _mysql_pool
+    if _mysql_pool is None:
+        _mysql_pool = mysql.connector.pooling.MySQLConnectionPool(
+            pool_name="ask",
+            pool_size=MYSQL_POOL_SIZE,
+            host=mysql_env.get("MYSQL_HOST", "localhost"),
+            port=int(mysql_env.get("MYSQL_PORT", 3306)),
+            user=mysql_env["MYSQL_USER"],
+            password=mysql_env["MYSQL_PASSWORD"],
+            database=mysql_env["MYSQL_DATABASE"],
+            charset="utf8mb4"
+        )
+    return _mysql_pool.get_connection()
+
+
+_RE_NONALNUM = re.compile(r"[^0-9a-z]+")
+_RE_UNDERSCORES = re.compile(r"_+")
+_RE_LEADING_DIGIT = re.compile(r"^[0-9]")
 
 
 def clean_collection_name(name: str) -> str:
-    slug = re.sub(r"[^0-9a-z]+", "_", name.lower())
-    slug = re.sub(r"_+", "_", slug).strip("_")
-    if re.match(r"^[0-9]", slug):
+    slug = _RE_NONALNUM.sub("_", name.lower())
+    slug = _RE_UNDERSCORES.sub("_", slug).strip("_")
+    if _RE_LEADING_DIGIT.match(slug):
         slug = f"c_{slug}"
     return slug
 
 
+# Below this many hits, Counter beats the fixed cost of building NumPy arrays.
+BINCOUNT_MIN_HITS = 64
+
+
+def most_common_bins(paragraph_indices, n):
+    """
+    Return the n most frequent paragraph indices as an ordered {index: count} dict.
+
+    Ties are broken by first appearance in `paragraph_indices` on both paths.
+    """
+    paragraph_indices = [idx for idx in paragraph_indices if idx is not None]
+    if len(paragraph_indices) < BINCOUNT_MIN_HITS:
+        return dict(Counter(paragraph_indices).most_common(n))
+    idxs = np.fromiter(paragraph_indices, dtype=np.int64, count=len(paragraph_indices))
+    bins, first_seen, counts = np.unique(idxs, return_index=True, return_counts=True)
+    # Highest count first; ties go to the bin hit first (the better-ranked search
+    # result), matching Counter.most_common on the small-input path
+    top = np.lexsort((first_seen, -counts))[:max(n, 0)]
+    return {int(bins[i]): int(counts[i]) for i in top}
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Query a text source with semantic search and retrieve context.")
     parser.add_argument('-n', '--name', required=True, help='Name of text source (collection)')
@@ -52,9 +94,15 @@ def parse_args():
 
 
 def get_qdrant_client():
-    return QdrantClient(
-        url=qdrant_env.get("QDRANT_URL", os.environ.get("QDRANT_URL", "http://localhost:6333"))
-    )
+    """Return the shared Qdrant client, which keeps one persistent gRPC channel open."""
+    global _qdrant_client
+    if _qdrant_client is None:
+        _qdrant_client = QdrantClient(
+            url=qdrant_env.get("QDRANT_URL", os.environ.get("QDRANT_URL", "http://localhost:6333")),
+            prefer_grpc=True,
+            grpc_port=int(qdrant_env.get("QDRANT_GRPC_PORT", os.environ.get("QDRANT_GRPC_PORT", 6334)))
+        )
+    return _qdrant_client
 
 def main():
     args = parse_args()
@@ -65,8 +113,8 @@ def main():
     mysql_conn = get_mysql_connection()
     mysql_cursor = mysql_conn.cursor(dictionary=True)
 
-    # Load embedding model
-    model = SentenceTransformer('all-MiniLM-L6-v2')
+    # Load embedding model. A single query is encoded per run, so use the int8 CPU encoder.
+    model = load_embedding_model(device='cpu')
 
     # Embed query
     print(f"Embedding query: '{args.query}'...")
@@ -77,15 +125,36 @@ def main():
     search_results = qdrant.search(
         collection_name=collection,
         query_vector=query_vec,
-        limit=args.k
+        limit=args.k,
+        with_payload=["paragraph_index"],  # only the field used for binning goes over the wire
+        with_vectors=False,
+        # Search the quantized vectors, then rescore the oversampled candidates at full precision
+        search_params=SearchParams(
+            quantization=QuantizationSearchParams(ignore=False, rescore=True, oversampling=3.0)
+        )
     )  # returns List[ScoredPoint]
 
-    # Histogram of paragraph indices
+    # Histogram of the most frequent paragraph indices
     paragraph_indices = [hit.payload.get('paragraph_index') for hit in search_results]
-    hist = Counter(paragraph_indices)
+    hist = most_common_bins(paragraph_indices, args.num_top_bins)
+    top_bins = list(hist)
 
-    # Select top 5 most frequent paragraphs
-    top_bins = [idx for idx, _ in hist.most_common(args.num_top_bins)]
+    # Fetch every paragraph needed by any top bin in a single round-trip.
+    # Served by the (source_name, paragraph_index) covering index:
+    #   CREATE INDEX idx_paragraphs_source_index ON paragraphs (source_name, paragraph_index)
+    wanted = set()
+    for p_idx in top_bins:
+        wanted.update(range(max(0, p_idx - args.flank), p_idx + args.flank + 1))
+    placeholders = ",".join(["%s"] * len(wanted))
+    by_idx = {}
+    if wanted:
+        mysql_cursor.execute(
+            "SELECT paragraph_index, paragraph_text FROM paragraphs "
+            f"WHERE source_name = %s AND paragraph_index IN ({placeholders}) "
+            "ORDER BY paragraph_index",
+            (args.name, *sorted(wanted))
+        )
+        by_idx = {row['paragraph_index']: row['paragraph_text'] for row in mysql_cursor.fetchall()}
 
     # Assemble contexts for top bins
     results = []
@@ -93,15 +162,7 @@ def main():
         count = hist[p_idx]
         start = max(0, p_idx - args.flank)
         end = p_idx + args.flank
-
-        mysql_cursor.execute(
-            "SELECT paragraph_index, paragraph_text FROM paragraphs "
-            "WHERE source_name = %s AND paragraph_index BETWEEN %s AND %s "
-            "ORDER BY paragraph_index",
-            (args.name, start, end)
-        )
-        paras = mysql_cursor.fetchall()
-        context_paras = [row['paragraph_text'] for row in paras]
+        context_paras = [by_idx[i] for i in range(start, end + 1) if i in by_idx]
 
         results.append({
             'paragraph_index': p_idx,
@@ -109,10 +170,11 @@ def main():
             'context_paragraphs': context_paras
         })
 
-    for i, result in enumerate(results):
-        print(f"Post-processing result {i+1}/{len(results)}...")
-        topic_name = mistral.completion({
-            "messages": [
+    # Name every topic in a single batched generate instead of one completion per result
+    print(f"Post-processing {len(results)} results...")
+    topic_names = mistral.batch_completion({
+        "conversations": [
+            [
                 {"role":"system", "content":
                  """
 Decide on a name for the topic covered in the provided text.
@@ -122,17 +184,21 @@ Output only the topic name and nothing else.
 """
                  },
                 {"role":"user", "content":"\n\n".join(result["context_paragraphs"])}
-            ],
+            ]
+            for result in results
+        ],
 
-            "max_tokens": 128,
-            "temperature":0.6,
-            "top_p":0.9,
-        }).strip().strip("'\"`")
-        result["topic_name"] = topic_name
+        "max_tokens": 128,
+        "temperature":0.6,
+        "top_p":0.9,
+        "stop_strings": ["\n"],  # the topic name is a single line
+    }) if results else []
+    for result, topic_name in zip(results, topic_names):
+        result["topic_name"] = topic_name.strip().strip("'\"`")
 
 
     mysql_cursor.close()
-    mysql_conn.close()
+    mysql_conn.close()  # returns the connection to the pool
 
     essay_user_message=f"""
 [[Question]]: {args.query}
@@ -3,17 +3,43 @@ import click
 import os
 import sys
 import re
-import uuid
+import tempfile
+import itertools
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
 import pysbd
-from sentence_transformers import SentenceTransformer
+import numpy as np
 import mysql.connector
 from qdrant_client import QdrantClient
-from qdrant_client.http.models import Distance, VectorParams, PointStruct
+from qdrant_client.http.models import (
+    Distance,
+    VectorParams,
+    BinaryQuantization,
+    BinaryQuantizationConfig,
+)
 from dotenv import dotenv_values
 from tqdm import tqdm as pb
 
+from src.embeddings import EMBEDDING_DIM, load_embedding_model, normalize_rows
+from src.utils.ids import random_uuids
+
 # Constants
-QDRANT_UPLOAD_BATCH_SIZE = 128
+QDRANT_UPLOAD_BATCH_SIZE = 256
+EMBED_BATCH_SIZE = 256
+EMBED_CHUNK_SIZE = EMBED_BATCH_SIZE * 16  # sentences per encode call handed to the Qdrant uploader
+EMBED_QUEUE_SIZE = 4
+# Normalized float32 embeddings are also saved here as debug/embeddings_<source_id>.npy,
+# one row per sentence_index (zeros for change markers), for plot_similarities.py to mmap
+DEBUG_DIR = "debug"
+SEGMENT_CHUNKSIZE = 16
+
+# Qdrant keeps a 1-bit copy of each vector in RAM for search and the original
+# float32 vectors on disk for rescoring. ask.py only bins hits by paragraph, so
+# the small rank noise of binary search is tolerable once candidates are rescored.
+QDRANT_QUANTIZATION_CONFIG = BinaryQuantization(
+    binary=BinaryQuantizationConfig(always_ram=True)
+)
 
 # Load environment variables
 mysql_env = dotenv_values(os.path.join(
@@ -31,7 +57,17 @@ def get_mysql_connection():
         user=mysql_env["MYSQL_USER"],
         password=mysql_env["MYSQL_PASSWORD"],
         database=mysql_env["MYSQL_DATABASE"],
-        charset="utf8mb4"
+        charset="utf8mb4",
+        allow_local_infile=True  # sentences are bulk loaded with LOAD DATA LOCAL INFILE
+    )
+
+
+def get_qdrant_client():
+    # gRPC sends float32 vectors as packed bytes rather than JSON number text
+    return QdrantClient(
+        url=qdrant_env.get("QDRANT_URL", os.environ.get("QDRANT_URL", "http://localhost:6333")),
+        prefer_grpc=True,
+        grpc_port=int(qdrant_env.get("QDRANT_GRPC_PORT", os.environ.get("QDRANT_GRPC_PORT", 6334)))
     )
 
 
@@ -83,22 +119,84 @@ def reset_qdrant(qdrant_client):
         qdrant_client.delete_collection(collection_name=coll.name)
 
 
+_NON_ALNUM = re.compile(r"[^0-9a-z]+")
+_MULTI_UNDER = re.compile(r"_+")
+_LEAD_DIGIT = re.compile(r"^[0-9]")
+# A newline followed by one or more whitespace-only (or empty) lines: paragraph break
+_PARAGRAPH_BREAK = re.compile(r"\n(?:[^\S\n]*\n)+")
+
+
 def clean_collection_name(name: str) -> str:
-    slug = re.sub(r"[^0-9a-z]+", "_", name.lower())
-    slug = re.sub(r"_+", "_", slug).strip("_")
-    if re.match(r"^[0-9]", slug):
+    slug = _NON_ALNUM.sub("_", name.lower())
+    slug = _MULTI_UNDER.sub("_", slug).strip("_")
+    if _LEAD_DIGIT.match(slug):
         slug = f"c_{slug}"
     return slug
 
 
 def clean_text_source(text: str) -> str:
     text = text.replace("\r\n", "\n").replace("\r", "")
-    text = text.strip()
-    lines = text.split("\n")
-    cleaned = ["" if line.strip() == "" else line for line in lines]
-    text = "\n".join(cleaned)
-    text = re.sub(r"\n{3,}", "\n\n", text)
-    return text
+    # Blanking whitespace-only lines and collapsing runs of blank lines in one regex pass
+    return _PARAGRAPH_BREAK.sub("\n\n", text.strip())
+
+
+# Sentence segmenter, built lazily once per process (including each pool worker)
+_segmenter = None
+
+
+def _init_segmenter():
+    global _segmenter
+    if _segmenter is None:
+        _segmenter = pysbd.Segmenter(language="en", char_span=False, clean=True, doc_type="pdf")
+    return _segmenter
+
+
+def _segment(chunk):
+    return [s.strip() for s in _init_segmenter().segment(chunk) if s.strip()]
+
+
+def _tsv_field(value):
+    """Encode a value for LOAD DATA's default format (backslash escapes, \\N for NULL)."""
+    if value is None:
+        return "\\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def load_sentence_rows(mysql_conn, rows):
+    """Stream (source_id, sentence_index, sentence_text, vector_uuid) rows into `sentences` in one round-trip."""
+    with tempfile.NamedTemporaryFile(mode="w", suffix=".tsv", encoding="utf-8", newline="\n") as tsv:
+        for row in rows:
+            tsv.write("\t".join(_tsv_field(v) for v in row))
+            tsv.write("\n")
+        tsv.flush()
+        cursor = mysql_conn.cursor()
+        cursor.execute(
+            "LOAD DATA LOCAL INFILE %s INTO TABLE sentences CHARACTER SET utf8mb4 "
+            "FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n' "
+            "(source_id, sentence_index, sentence_text, vector_uuid)",
+            (tsv.name,)
+        )
+        # With LOCAL, conversion and duplicate-key errors are downgraded to warnings and the
+        # offending rows truncated or skipped, so check the outcome instead of trusting it
+        loaded = cursor.rowcount
+        cursor.execute("SHOW WARNINGS")
+        warnings = [w for w in cursor.fetchall() if w[0] != "Note"]
+        if loaded != len(rows) or warnings:
+            mysql_conn.rollback()
+            cursor.close()
+            details = "; ".join(f"{w[0]} {w[1]}: {w[2]}" for w in warnings[:5])
+            raise RuntimeError(
+                f"LOAD DATA loaded {loaded} of {len(rows)} sentence rows"
+                + (f" ({len(warnings)} warnings: {details})" if warnings else "")
+            )
+        mysql_conn.commit()
+        cursor.close()
 
 
 def process_document(text, title, identifier, author, mysql_conn, qdrant_client):
@@ -124,7 +222,8 @@ def process_document(text, title, identifier, author, mysql_conn, qdrant_client)
         qdrant_client.delete_collection(collection_name=source_id)
     qdrant_client.create_collection(
         collection_name=source_id,
-        vectors_config=VectorParams(size=384, distance=Distance.COSINE)
+        vectors_config=VectorParams(size=EMBEDDING_DIM, distance=Distance.COSINE, on_disk=True),
+        quantization_config=QDRANT_QUANTIZATION_CONFIG
     )
 
     clear_source_data(mysql_conn, source_id)
@@ -132,65 +231,141 @@ def process_document(text, title, identifier, author, mysql_conn, qdrant_client)
     raw_chunks = text.split("\n\n")
     chunks = [c.strip() for c in raw_chunks if c.strip()]
 
-    click.echo("Loading sentence segmenter...")
-    seg = pysbd.Segmenter(language="en", char_span=False, clean=True, doc_type="pdf")
-    click.echo("Done loading segmenter.")
+    # pysbd is pure-Python regex work that holds the GIL, so segment chunks across processes
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=_init_segmenter) as pool:
+        per_chunk = list(pb(
+            pool.map(_segment, chunks, chunksize=SEGMENT_CHUNKSIZE),
+            total=len(chunks),
+            desc="Parsing document"
+        ))
 
     all_sentences = []
-    with pb(total=len(chunks), desc="Parsing document") as pbar:
-        for chunk in chunks:
-            all_sentences.extend([s.strip() for s in seg.segment(chunk) if s.strip() and s.strip()!= ""])
-            all_sentences.append("")
-            pbar.update(1)
-    all_sentences.pop()
-
-    total_sentences = len(all_sentences)
+    for chunk_sentences in per_chunk:
+        all_sentences.extend(chunk_sentences)
+        all_sentences.append("")
+    if all_sentences:
+        all_sentences.pop()
+
     embed_sentences = [s for s in all_sentences if s]
    
-    model = SentenceTransformer('all-MiniLM-L6-v2')
-    embeddings = model.encode(embed_sentences, show_progress_bar=True)
-
-    pbar = pb(total=total_sentences, desc="Ingesting sentences")
-    sentence_idx = 0
-    embed_iter = iter(embeddings)
-    points = []
-
-    for sent in all_sentences:
-        # Generate UUID for vector if sentence is non-empty
-        vector_id = str(uuid.uuid4()) if sent else None
-        # Insert sentence record with vector_uuid (nullable)
-        cursor = mysql_conn.cursor()
-        cursor.execute(
-            "INSERT INTO sentences (source_id, sentence_index, sentence_text, vector_uuid) VALUES (%s, %s, %s, %s)",
-            (source_id, sentence_idx, sent, vector_id)
-        )
-        mysql_conn.commit()
-        cursor.close()
+    # Sentence records with vector_uuid (nullable); ids line up with `embed_sentences`.
+    # Ids are assigned before encoding so the MySQL load does not have to wait for vectors.
+    vector_ids = random_uuids(len(embed_sentences))
+    id_iter = iter(vector_ids)
+    rows = [
+        (source_id, sentence_idx, sent, next(id_iter) if sent else None)
+        for sentence_idx, sent in enumerate(all_sentences)
+    ]
+
+    payloads = (
+        {
+            "source_id": source_id,
+            "sentence_index": sentence_idx,
+            "sentence_text": sent,
+            "title": title,
+            "author": author
+        }
+        for sentence_idx, sent in enumerate(all_sentences) if sent
+    )
 
-        if sent:
-            vec = next(embed_iter)
-            # Prepare point with same UUID
-            points.append(
-                PointStruct(
-                    id=vector_id,
-                    vector=vec.tolist(),
-                    payload={
-                        "source_id": source_id,
-                        "sentence_index": sentence_idx,
-                        "sentence_text": sent,
-                        "title": title,
-                        "author": author
-                    }
+    # Encoding (producer, main thread) overlaps with the MySQL bulk load and the
+    # Qdrant uploads (consumer threads); both consumers spend their time in socket I/O.
+    embed_queue = queue.Queue(maxsize=EMBED_QUEUE_SIZE)
+    errors = []
+
+    def mysql_worker():
+        try:
+            load_sentence_rows(mysql_conn, rows)
+        except Exception as exc:
+            errors.append(exc)
+
+    def qdrant_worker():
+        failed = False
+        while True:
+            item = embed_queue.get()
+            if item is None:
+                return
+            if failed:
+                continue  # keep draining so the producer never blocks on a full queue
+            offset, chunk_embeddings = item
+            try:
+                # Upload the chunk matrix as-is (no per-vector .tolist()). parallel=1: with
+                # parallel > 1 qdrant-client starts a new worker-process pool on every call
+                qdrant_client.upload_collection(
+                    collection_name=source_id,
+                    vectors=chunk_embeddings,
+                    payload=itertools.islice(payloads, len(chunk_embeddings)),
+                    ids=vector_ids[offset:offset + len(chunk_embeddings)],
+                    batch_size=QDRANT_UPLOAD_BATCH_SIZE,
+                    parallel=1,
+                    wait=True
                 )
-            )
-        sentence_idx += 1
-        pbar.update(1)
-    pbar.close()
-
-    # Batch upload to Qdrant
-    for i in range(0, len(points), QDRANT_UPLOAD_BATCH_SIZE):
-        batch = points[i:i + QDRANT_UPLOAD_BATCH_SIZE]
-        qdrant_client.upsert(collection_name=source_id, points=batch)
+            except Exception as exc:
+                errors.append(exc)
+                failed = True
+
+    # fp16 SentenceTransformer on GPU, int8 ONNX Runtime on CPU; normalized in fp32 below.
+    # Both backends length-sort within each encode call, so each mini-batch is padded
+    # only to its own longest sentence. Loaded before the workers start, so a failed
+    # load (first ONNX export, CUDA OOM) writes nothing.
+    model = load_embedding_model()
+    # Written under a temporary name and moved into place only once every vector has
+    # been encoded and stored, so a failed ingest never leaves zero rows behind.
+    # Any file from a previous ingest of this source is stale from here on.
+    os.makedirs(DEBUG_DIR, exist_ok=True)
+    stored_path = os.path.join(DEBUG_DIR, f"embeddings_{source_id}.npy")
+    stored_tmp_path = stored_path + ".partial"
+    if os.path.exists(stored_path):
+        os.remove(stored_path)
+    stored = np.lib.format.open_memmap(
+        stored_tmp_path,
+        mode="w+",
+        dtype=np.float32,
+        shape=(len(all_sentences), EMBEDDING_DIM),
+    )
+    embed_rows = np.flatnonzero([bool(s) for s in all_sentences])
+
+    click.echo(f"Loading {len(rows)} sentences into MySQL and {len(vector_ids)} vectors into Qdrant...")
+    workers = [
+        threading.Thread(target=mysql_worker, name="mysql-load"),
+        threading.Thread(target=qdrant_worker, name="qdrant-upload"),
+    ]
+    encoded = False
+    try:
+        # Started inside the try so the sentinel below always reaches the uploader
+        for worker in workers:
+            worker.start()
+        for offset in pb(range(0, len(embed_sentences), EMBED_CHUNK_SIZE), desc="Encoding"):
+            chunk_embeddings = model.encode(
+                embed_sentences[offset:offset + EMBED_CHUNK_SIZE],
+                batch_size=EMBED_BATCH_SIZE,
+                show_progress_bar=False,
+                convert_to_numpy=True,
+            ).astype(np.float32, copy=False)
+            normalize_rows(chunk_embeddings)
+            embed_queue.put((offset, chunk_embeddings))
+            stored[embed_rows[offset:offset + len(chunk_embeddings)]] = chunk_embeddings
+        encoded = True
+    finally:
+        embed_queue.put(None)
+        for worker in workers:
+            if worker.is_alive():
+                worker.join()
+        stored.flush()
+        del stored
+        if encoded and not errors:
+            os.replace(stored_tmp_path, stored_path)
+        else:
+            os.remove(stored_tmp_path)
+            # Don't leave sentence rows (or a partial collection) without their vectors
+            try:
+                clear_source_data(mysql_conn, source_id)
+                qdrant_client.delete_collection(collection_name=source_id)
+            except Exception as exc:
+                click.echo(f"Cleanup after failed ingest of {source_id} failed: {exc}", err=True)
+
+    if errors:
+        raise errors[0]
 
 @click.group()
 def cli():
@@ -203,7 +378,7 @@ def cli():
 @click.option('-a', '--author', help='Author of the source')
 def ingest(infile, title, identifier, author):
     mysql_conn = get_mysql_connection()
-    qdrant_client = QdrantClient(url=qdrant_env.get("QDRANT_URL", os.environ.get("QDRANT_URL", "http://localhost:6333")))
+    qdrant_client = get_qdrant_client()
     raw = infile.read() if infile else (sys.stdin.read() if not sys.stdin.isatty() else None)
     if raw is None:
         raise click.UsageError("No input: use -f or pipe via stdin.")
@@ -219,7 +394,7 @@ def reset(yes):
         click.echo("Reset aborted.")
         sys.exit(0)
     mysql_conn = get_mysql_connection()
-    qdrant_client = QdrantClient(url=qdrant_env.get("QDRANT_URL", os.environ.get("QDRANT_URL", "http://localhost:6333")))
+    qdrant_client = get_qdrant_client()
     drop_tables(mysql_conn)
     reset_qdrant(qdrant_client)
     mysql_conn.close()
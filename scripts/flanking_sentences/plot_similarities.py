@@ -3,6 +3,7 @@ import os
 import sys
 import click
 import numpy as np
+from numba import njit, prange
 import matplotlib.pyplot as plt
 from dotenv import dotenv_values
 import mysql.connector
@@ -10,6 +11,7 @@ from qdrant_client import QdrantClient
 from tqdm import tqdm as pb
 
 DEBUG_DIR = "debug"
+QDRANT_RETRIEVE_BATCH_SIZE = 1024
 
 def get_mysql_connection():
     mysql_env = dotenv_values(os.path.join(
@@ -24,6 +26,75 @@ def get_mysql_connection():
         charset="utf8mb4"
     )
 
+def fetch_vectors(qdrant_client, collection_name, uuids):
+    """
+    Retrieve vectors for `uuids` in bulk and stack them into an (N, dim) float32 matrix.
+
+    Rows whose uuid is None (change markers) or missing from Qdrant are left as NaN.
+    Returns the matrix and a boolean mask of rows that hold a real vector.
+    """
+    wanted = [u for u in uuids if u]
+    by_id = {}
+    with pb(total=len(wanted), desc="Fetching vectors") as pbar:
+        for i in range(0, len(wanted), QDRANT_RETRIEVE_BATCH_SIZE):
+            batch = wanted[i:i + QDRANT_RETRIEVE_BATCH_SIZE]
+            points = qdrant_client.retrieve(
+                collection_name=collection_name,
+                ids=batch,
+                with_vectors=True,
+                with_payload=False
+            )
+            # Qdrant does not guarantee result order, so key by id
+            by_id.update({str(p.id): p.vector for p in points})
+            pbar.update(len(batch))
+
+    dim = len(next(iter(by_id.values()))) if by_id else 0
+    V = np.full((len(uuids), dim), np.nan, dtype=np.float32)
+    valid = np.zeros(len(uuids), dtype=bool)
+    for row, u in enumerate(uuids):
+        vec = by_id.get(str(u)) if u else None
+        if vec is not None:
+            V[row] = vec
+            valid[row] = True
+    return V, valid
+
+def load_stored_vectors(source_id, sentence_indices, uuids, total_sentences):
+    """
+    Memory-map the embeddings ingest.py saved for `source_id` and gather the rows
+    for `sentence_indices`. Returns None when no file matching the current
+    sentence count exists, so the caller can fall back to Qdrant.
+    """
+    path = os.path.join(DEBUG_DIR, f"embeddings_{source_id}.npy")
+    if not os.path.isfile(path):
+        return None
+    stored = np.load(path, mmap_mode="r")
+    if stored.shape[0] != total_sentences:
+        return None
+    V = np.asarray(stored[np.asarray(sentence_indices, dtype=np.int64)])
+    valid = np.array([u is not None for u in uuids], dtype=bool)
+    return V, valid
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _adj_cos(V, valid):
+    """Cosine similarity of each row of V with the next row; NaN where either row is invalid."""
+    n, dim = V.shape
+    out = np.empty(max(n - 1, 0), dtype=np.float32)
+    for i in prange(n - 1):
+        if valid[i] and valid[i + 1]:
+            dot = 0.0
+            norm0 = 0.0
+            norm1 = 0.0
+            for j in range(dim):
+                a = V[i, j]
+                b = V[i + 1, j]
+                dot += a * b
+                norm0 += a * a
+                norm1 += b * b
+            out[i] = dot / np.sqrt(norm0 * norm1)
+        else:
+            out[i] = np.nan
+    return out
+
 def get_qdrant_client():
     qdrant_env = dotenv_values(os.path.join(
         os.path.dirname(__file__), "..", "..", "servers", "qdrant", ".env"
@@ -82,30 +153,15 @@ def analyze_similarities(source_id, count, offset):
     sub_indices = indices[offset:end]
     sub_uuids = uuids[offset:end]
 
-    # Compute similarities
-    sims = []
-    pbar = pb(total=len(sub_indices) - 1, desc="Computing similarities")
-    for i in range(1, len(sub_indices)):
-        prev_uuid = sub_uuids[i - 1]
-        curr_uuid = sub_uuids[i]
-        if prev_uuid and curr_uuid:
-            prev_point = qdrant_client.retrieve(
-                collection_name=source_id,
-                ids=[prev_uuid],
-                with_vectors=True
-            )
-            curr_point = qdrant_client.retrieve(
-                collection_name=source_id,
-                ids=[curr_uuid],
-                with_vectors=True
-            )
-            v0 = np.array(prev_point[0].vector)
-            v1 = np.array(curr_point[0].vector)
-            sims.append(float(np.dot(v0, v1) / (np.linalg.norm(v0) * np.linalg.norm(v1))))
-        else:
-            sims.append(np.nan)
-        pbar.update(1)
-    pbar.close()
+    # Compute similarities between each sentence and the previous one in one fused,
+    # parallel pass; pairs touching a change marker are undefined (NaN)
+    stored = load_stored_vectors(source_id, sub_indices, sub_uuids, total_sentences)
+    if stored is not None:
+        click.echo("Using embeddings saved at ingest time.")
+        V, valid = stored
+    else:
+        V, valid = fetch_vectors(qdrant_client, source_id, sub_uuids)
+    sims = _adj_cos(V, valid).astype(np.float64)
 
     # Prepare plot data
     x = np.array(sub_indices[1:])
@@ -0,0 +1,134 @@
+import os
+from typing import List, Optional
+
+import numpy as np
+import torch
+from tqdm import tqdm
+from transformers import AutoTokenizer
+from sentence_transformers import SentenceTransformer
+
+from src.utils.project_structure import get_project_root
+
+EMBEDDING_MODEL_ID = "sentence-transformers/all-MiniLM-L6-v2"
+EMBEDDING_DIM = 384
+EMBEDDING_MAX_SEQ_LENGTH = 256  # same truncation length sentence-transformers uses for this model
+
+# Where the exported + int8-quantized ONNX copy of the model is cached
+ONNX_MODEL_DIR = os.path.join(
+    get_project_root(os.path.dirname(os.path.abspath(__file__))),
+    "models", "onnx", "all-MiniLM-L6-v2-int8",
+)
+ONNX_QUANTIZED_FILE_NAME = "model_quantized.onnx"
+
+
+def normalize_rows(embeddings: np.ndarray) -> np.ndarray:
+    """
+    L2-normalize the rows of a float32 matrix in place and return it.
+
+    The row norms come from a single einsum reduction, so unlike
+    `X / np.linalg.norm(X, axis=1, keepdims=True)` no (N, dim) temporary is allocated.
+    """
+    norms = np.sqrt(np.einsum("ij,ij->i", embeddings, embeddings))
+    embeddings /= norms[:, None]
+    return embeddings
+
+
+class OnnxSentenceEncoder:
+    """
+    ONNX Runtime (CPU, int8) replacement for SentenceTransformer('all-MiniLM-L6-v2').
+
+    Implements the subset of `SentenceTransformer.encode` used in this project:
+    sort sentences by length, tokenize each batch padded to its own longest
+    sentence, run the ORT session, mean-pool over the attention mask and
+    optionally L2-normalize. Output rows are in the original input order.
+    """
+
+    def __init__(self, model_dir: str = ONNX_MODEL_DIR):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+
+        if not os.path.isfile(os.path.join(model_dir, ONNX_QUANTIZED_FILE_NAME)):
+            _export_quantized_onnx(model_dir)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_dir,
+            file_name=ONNX_QUANTIZED_FILE_NAME,
+            provider="CPUExecutionProvider",
+        )
+
+    def encode(
+        self,
+        sentences: List[str],
+        batch_size: int = 64,
+        show_progress_bar: bool = False,
+        convert_to_numpy: bool = True,
+        normalize_embeddings: bool = False,
+    ) -> np.ndarray:
+        embeddings = np.empty((len(sentences), EMBEDDING_DIM), dtype=np.float32)
+        # Length-sorted batches hold similar-length sentences, so little compute is spent on padding
+        order = np.argsort([len(s) for s in sentences], kind="stable")
+        starts = range(0, len(sentences), batch_size)
+        for start in tqdm(starts, desc="Batches", disable=not show_progress_bar):
+            batch_rows = order[start:start + batch_size]
+            batch = [sentences[i] for i in batch_rows]
+            enc = self.tokenizer(
+                batch,
+                padding="longest",
+                truncation=True,
+                max_length=EMBEDDING_MAX_SEQ_LENGTH,
+                return_tensors="np",
+            )
+            hidden = self.model(**enc).last_hidden_state
+            mask = enc["attention_mask"][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            embeddings[batch_rows] = pooled  # scatter back to input order
+        if normalize_embeddings:
+            normalize_rows(embeddings)
+        return embeddings
+
+
+def _export_quantized_onnx(model_dir: str) -> None:
+    """Export the model to ONNX once and apply int8 dynamic quantization (VNNI kernels)."""
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+    os.makedirs(model_dir, exist_ok=True)
+    model = ORTModelForFeatureExtraction.from_pretrained(EMBEDDING_MODEL_ID, export=True)
+    model.save_pretrained(model_dir)
+    AutoTokenizer.from_pretrained(EMBEDDING_MODEL_ID).save_pretrained(model_dir)
+    quantizer = ORTQuantizer.from_pretrained(model)
+    qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    quantizer.quantize(save_dir=model_dir, quantization_config=qconfig)
+
+
+def load_embedding_model(device: Optional[str] = None):
+    """
+    Load the all-MiniLM-L6-v2 sentence encoder on the fastest available backend.
+
+    device:
+      - None: CUDA if available, otherwise CPU
+      - "cpu": ONNX Runtime int8 encoder when optimum[onnxruntime] is installed,
+        otherwise SentenceTransformer with int8 dynamically quantized Linear layers
+      - "cuda" / "cuda:N": SentenceTransformer in fp16
+
+    Every backend exposes `encode(sentences, batch_size=..., show_progress_bar=...,
+    convert_to_numpy=..., normalize_embeddings=...)`.
+    """
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    if device.startswith("cuda"):
+        model = SentenceTransformer(EMBEDDING_MODEL_ID, device=device)
+        model.half()
+        return model
+
+    try:
+        return OnnxSentenceEncoder()
+    except ImportError:
+        # Let the torch fallback use every core (PyTorch defaults to physical cores only);
+        # ONNX Runtime sizes its own thread pool and ignores this setting
+        torch.set_num_threads(os.cpu_count() or 1)
+        model = SentenceTransformer(EMBEDDING_MODEL_ID, device="cpu")
+        model[0].auto_model = torch.quantization.quantize_dynamic(
+            model[0].auto_model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+        return model
@@ -1,19 +1,26 @@
 from dataclasses import dataclass
+import functools
 from typing import List, Literal, Optional, TypedDict, Union
-from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
+from transformers import (
+    AutoTokenizer,
+    AutoModelForCausalLM,
+    BitsAndBytesConfig,
+)
+from transformers.utils import is_flash_attn_2_available
 import torch
 import pynvml
 import psutil
 from collections import defaultdict
 from termcolor import colored
-from torch.nn.utils.rnn import pad_sequence
-import re
 
 MODEL_ID = "mistralai/Mistral-Nemo-Instruct-2407"
 
 # Static constants
 DEFAULT_GPU_HEADROOM_PCT = 0.15          # reserve 15% of each GPU for activations, cache, allocator
 DEFAULT_OS_RAM_RESERVE_GB = 4           # reserve 4GB of system RAM for OS/processes
+COMPILE_WARMUP_TOKENS = 3               # prefill + two decode steps, so the decode graph gets captured
+EMPTY_CACHE_EVERY = 64                  # generations between allocator fragmentation checks
+PREFIX_SHARE_MIN_TOKENS = 64            # shortest common prompt prefix worth prefilling once per batch
 
 # Pre-init NVML once at module load
 try:
@@ -22,18 +29,64 @@ except Exception:
     pass
 
 
+# Pre-quantized checkpoints (AWQ/GPTQ) carry their own quantization config and run on
+# fused int4 x fp16 GEMM kernels. The bitsandbytes "4bit"/"8bit" modes dequantize
+# before every matmul and are slower; they remain the fallback when only the
+# original bf16 weights are available. (FP8 is served by vllm_servers/mistral.sh.)
+PREQUANTIZED_METHODS = ("awq", "gptq")
+
 bnb_config_8bit = BitsAndBytesConfig(
     load_in_4bit=False,
     bnb_4bit_quant_type="nf4",
     bnb_4bit_compute_dtype=torch.bfloat16,
 )
 
+# Double quantization also quantizes the per-block scales (~0.4 bit/param saved), which
+# is enough headroom to keep every layer on the GPU without a CPU offload shard
 bnb_config_4bit = BitsAndBytesConfig(
     load_in_4bit=True,
     bnb_4bit_quant_type="nf4",
     bnb_4bit_compute_dtype=torch.bfloat16,
+    bnb_4bit_use_double_quant=True,
+    bnb_4bit_quant_storage=torch.bfloat16,
 )
 
+@functools.lru_cache(maxsize=None)
+def _nvml_handle(idx: int):
+    # NVML handles are stable for the life of the process
+    return pynvml.nvmlDeviceGetHandleByIndex(idx)
+
+
+@functools.lru_cache(maxsize=None)
+def _compute_budgets(ids: tuple, gpu_headroom_pct: float, ram_budget_gb: Optional[int]) -> dict:
+    """
+    Build the Accelerate `max_memory` dict for GPUs `ids` plus CPU RAM.
+
+    Memoized so repeated Mistral constructions (tests, servers that reload) skip
+    the NVML and psutil queries. Callers must copy the result before editing it.
+    """
+    # Build max_memory budget dict with integer GPU keys
+    budgets = {}
+    for idx in ids:
+        total_gb = pynvml.nvmlDeviceGetMemoryInfo(_nvml_handle(idx)).total // (1024**3)
+        headroom = max(1, int(total_gb * gpu_headroom_pct))
+        avail = total_gb - headroom
+        if avail <= 0:
+            raise ValueError(
+                f"Computed GPU headroom {headroom}GB >= GPU {idx} total {total_gb}GB"
+            )
+        # Use integer keys to match Accelerate's expected device identifiers
+        budgets[idx] = f"{avail}GB"
+
+    # CPU RAM budget
+    system_ram_gb = psutil.virtual_memory().total // (1024**3)
+    if ram_budget_gb is None:
+        cpu_budget = max(0, system_ram_gb - DEFAULT_OS_RAM_RESERVE_GB)
+    else:
+        cpu_budget = min(ram_budget_gb, system_ram_gb - DEFAULT_OS_RAM_RESERVE_GB)
+    budgets["cpu"] = f"{cpu_budget}GB"
+    return budgets
+
 @dataclass
 class Message:
     role: Literal["user", "assistant", "system"]
@@ -44,12 +97,14 @@ class CompletionRequest(TypedDict):
     top_p: Optional[float]
     max_tokens: Optional[int]
     temperature: Optional[float]
+    stop_strings: Optional[List[str]]
 
 class BatchCompletionRequest(TypedDict):
     conversations: List[List[Message]]
     top_p: Optional[float]
     max_tokens: Optional[int]
     temperature: Optional[float]
+    stop_strings: Optional[List[str]]
 
 @dataclass
 class OutOfTokensError(Exception):
@@ -71,17 +126,25 @@ class Mistral:
     def __init__(
         self,
         model_id: str = MODEL_ID,
-        quantization: Optional[Literal["8bit", "4bit"]] = None,
+        quantization: Optional[Literal["8bit", "4bit", "awq", "gptq"]] = None,
+        revision: Optional[str] = None,
         default_temperature: float = 0.6,
         default_top_p: float = 0.9,
         pad_margin: int = 2,
         device_ids: Optional[Union[int, List[int]]] = None,
         gpu_headroom_pct: float = DEFAULT_GPU_HEADROOM_PCT,
         ram_budget_gb: Optional[int] = None,
+        compile_model: bool = False,
     ):
         """
         Initialize Mistral model with explicit GPU and CPU budgeting.
 
+        quantization:
+          - None: bf16 weights
+          - "awq" / "gptq": `model_id` (and optionally `revision`, e.g. "gptq-4bit-128g")
+            must name a checkpoint already quantized with that method; loaded in fp16
+          - "4bit" / "8bit": quantize `model_id` on load with bitsandbytes
+
         device_ids:
           - None: use all available GPUs
           - int: use specified GPU
@@ -89,11 +152,15 @@ class Mistral:
 
         gpu_headroom_pct: fraction of each GPU to reserve for activations and overhead
         ram_budget_gb: max GB to use on CPU RAM; None = full system RAM minus OS reserve
+        compile_model: torch.compile the forward pass (mode="reduce-overhead", i.e. CUDA
+          graphs) over a static KV cache. Slow first calls per prompt shape; disables
+          shared-prefix prefill, which needs a dynamic cache.
         """
         # Detect GPUs
         total_gpus = torch.cuda.device_count()
         if total_gpus == 0:
             raise RuntimeError("No CUDA-capable GPUs detected. Cannot initialize model on GPU.")
+        self._nvml_handles = [_nvml_handle(i) for i in range(total_gpus)]
         if device_ids is None:
             ids = list(range(total_gpus))
         else:
@@ -102,40 +169,46 @@ class Mistral:
             if invalid:
                 raise ValueError(f"Invalid device IDs: {invalid}")
 
-        # Build max_memory budget dict with integer GPU keys
-        budgets = {}
-        for idx in ids:
-            handle = pynvml.nvmlDeviceGetHandleByIndex(idx)
-            total_gb = pynvml.nvmlDeviceGetMemoryInfo(handle).total // (1024**3)
-            headroom = max(1, int(total_gb * gpu_headroom_pct))
-            avail = total_gb - headroom
-            if avail <= 0:
-                raise ValueError(
-                    f"Computed GPU headroom {headroom}GB >= GPU {idx} total {total_gb}GB"
-                )
-            # Use integer keys to match Accelerate's expected device identifiers
-            budgets[idx] = f"{avail}GB"
-
-        # CPU RAM budget
-        system_ram_gb = psutil.virtual_memory().total // (1024**3)
-        if ram_budget_gb is None:
-            cpu_budget = max(0, system_ram_gb - DEFAULT_OS_RAM_RESERVE_GB)
-        else:
-            cpu_budget = min(ram_budget_gb, system_ram_gb - DEFAULT_OS_RAM_RESERVE_GB)
-        budgets["cpu"] = f"{cpu_budget}GB"
+        # Copied because the 4-bit path below edits the CPU entry
+        budgets = dict(_compute_budgets(tuple(ids), gpu_headroom_pct, ram_budget_gb))
 
         # Load tokenizer and model with explicit budgets
-        self.tokenizer = AutoTokenizer.from_pretrained(model_id)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_id, revision=revision)
         self.tokenizer.pad_token_id = self.tokenizer.eos_token_id
+        # Decoder-only generation continues from the last column, so prompts are right-aligned
+        self.tokenizer.padding_side = "left"
         load_kwargs = {
             "device_map": "auto",
             "torch_dtype": torch.bfloat16,
             "max_memory": budgets,
+            "revision": revision,
         }
-        if quantization:
+        if quantization in PREQUANTIZED_METHODS:
+            if model_id == MODEL_ID:
+                raise ValueError(
+                    f"quantization='{quantization}' requires a pre-quantized {quantization.upper()} "
+                    f"checkpoint as model_id, not {MODEL_ID}"
+                )
+            # AWQ/GPTQ kernels compute in fp16
+            load_kwargs["torch_dtype"] = torch.float16
+        elif quantization:
             qconfig = bnb_config_4bit if quantization == "4bit" else bnb_config_8bit
             load_kwargs["quantization_config"] = qconfig
+            if quantization == "4bit":
+                # Pack into GPU memory only; a CPU shard would dominate per-token latency
+                budgets["cpu"] = "0GB"
+        # FlashAttention-2 when flash-attn is installed; PyTorch SDPA otherwise, and under
+        # bitsandbytes quantization, where FA2 is less stable
+        bnb_quantized = quantization in ("4bit", "8bit")
+        load_kwargs["attn_implementation"] = (
+            "flash_attention_2" if is_flash_attn_2_available() and not bnb_quantized else "sdpa"
+        )
         self.model = AutoModelForCausalLM.from_pretrained(model_id, **load_kwargs)
+        self.model.eval()
+        # The device map is fixed after loading, so per-device parameter totals are computed once
+        self._shard_distribution = self._compute_shard_distribution()
+        # Prompts go where the embedding layer lives; resolved once instead of per batch
+        self._input_device = self.model.get_input_embeddings().weight.device
 
         # Store settings
         self.default_temperature = default_temperature
@@ -144,6 +217,32 @@ class Mistral:
         cfg = self.model.config
         self.hard_limit = getattr(cfg, "max_position_embeddings", None)
         self.sliding_window = getattr(cfg, "sliding_window", None)
+        # Periodic allocator check, see _maybe_empty_cache
+        self._generation_count = 0
+        self._alloc_retries = self._count_alloc_retries()
+        # Per-instance LRU cache; a class-level cache would keep every Mistral (and its model) alive
+        self._render_prompt = functools.lru_cache(maxsize=256)(self._render_prompt_uncached)
+
+        self.compiled = compile_model
+        if compile_model:
+            # A fixed-shape KV cache lets the decode step be captured as a CUDA graph,
+            # removing the per-kernel launch overhead that dominates small-batch decode
+            self.model.generation_config.cache_implementation = "static"
+            self.model.forward = torch.compile(
+                self.model.forward, mode="reduce-overhead", fullgraph=False, dynamic=True
+            )
+            # Compile and capture both the prefill and the decode step here rather than on
+            # the first request; a single new token would only run the prefill. Batch sizes
+            # and prompt lengths not seen yet can still trigger recompilation later.
+            warmup = self.tokenizer(["Hello"], return_tensors="pt").to(self._input_device)
+            with torch.inference_mode():
+                self.model.generate(
+                    **warmup,
+                    do_sample=False,
+                    min_new_tokens=COMPILE_WARMUP_TOKENS,
+                    max_new_tokens=COMPILE_WARMUP_TOKENS,
+                    pad_token_id=self.tokenizer.pad_token_id,
+                )
 
     def _compute_max_new_tokens(self, input_ids_len: int) -> int:
         budget = self.sliding_window or self.hard_limit
@@ -158,41 +257,83 @@ class Mistral:
         max_tokens: int,
         top_p: float,
         temperature: float,
+        stop_strings: Optional[List[str]] = None,
+        past_key_values=None,
     ) -> torch.Tensor:
-        return self.model.generate(
-            input_ids,
-            attention_mask=attention_mask,
-            do_sample=True,
-            temperature=temperature,
-            top_p=top_p,
-            max_new_tokens=max_tokens,
-            pad_token_id=self.tokenizer.pad_token_id,
-            eos_token_id=self.tokenizer.eos_token_id,
+        # inference_mode also skips the version counters / view tracking no_grad still keeps
+        with torch.inference_mode():
+            return self.model.generate(
+                input_ids,
+                attention_mask=attention_mask,
+                past_key_values=past_key_values,
+                do_sample=True,
+                temperature=temperature,
+                top_p=top_p,
+                max_new_tokens=max_tokens,
+                pad_token_id=self.tokenizer.pad_token_id,
+                eos_token_id=self.tokenizer.eos_token_id,
+                # Matched on decoded text, so stops inside merged tokens (e.g. ".\n") are caught
+                stop_strings=stop_strings or None,
+                tokenizer=self.tokenizer,
+            )
+
+    def _count_alloc_retries(self) -> int:
+        return sum(
+            torch.cuda.memory_stats(i).get("num_alloc_retries", 0) for i in range(len(self._nvml_handles))
         )
 
+    def _maybe_empty_cache(self) -> None:
+        """
+        Every EMPTY_CACHE_EVERY generations, release cached allocator blocks if the
+        caching allocator had to retry allocations since the last check.
+
+        Variable-length prompts leave fragmented free blocks behind over a long
+        session; flushing only when retries actually occurred keeps the cost of
+        re-allocating from the driver off the common path.
+        """
+        self._generation_count += 1
+        if self._generation_count % EMPTY_CACHE_EVERY:
+            return
+        retries = self._count_alloc_retries()
+        if retries > self._alloc_retries:
+            torch.cuda.empty_cache()
+        self._alloc_retries = retries
+
     def report_memory_usage(self) -> None:
         try:
-            for i in range(torch.cuda.device_count()):
-                handle = pynvml.nvmlDeviceGetHandleByIndex(i)
+            for i, handle in enumerate(self._nvml_handles):
                 mem = pynvml.nvmlDeviceGetMemoryInfo(handle)
                 reserved = torch.cuda.memory_reserved(i) / 2**30
                 allocated = torch.cuda.memory_allocated(i) / 2**30
+                # Allocator retries (cache flushes to satisfy a request) are an early sign of fragmentation
+                stats = torch.cuda.memory_stats(i)
                 print(
                     f"GPU {i}: driver_used={mem.used/2**30:.2f}GB, "
-                    f"reserved={reserved:.2f}GB, allocated={allocated:.2f}GB"
+                    f"reserved={reserved:.2f}GB, allocated={allocated:.2f}GB, "
+                    f"alloc_retries={stats.get('num_alloc_retries', 0)}, ooms={stats.get('num_ooms', 0)}"
                 )
             self._report_model_shard_distribution()
         except Exception as e:
             print(colored(f"Memory report error: {e}", "red"))
 
-    def _report_model_shard_distribution(self) -> None:
+    def _compute_shard_distribution(self) -> dict:
         device_params = defaultdict(lambda: {"count": 0, "bytes": 0})
         for _, p in self.model.named_parameters():
             dev = str(p.device)
             device_params[dev]["count"] += p.numel()
             device_params[dev]["bytes"] += p.numel() * p.element_size()
+        return dict(device_params)
+
+    def _report_model_shard_distribution(self) -> None:
+        print(f"attention: {self.model.config._attn_implementation}")
+        device_params = self._shard_distribution
         for dev, s in device_params.items():
             print(f"{dev}: {s['bytes']/2**30:.2f}GB in {s['count']} params")
+        if "cpu" in device_params:
+            print(colored(
+                "Warning: some parameters are offloaded to CPU; generation will be slow.",
+                "yellow",
+            ))
 
     def completion(self, payload: CompletionRequest) -> str:
         batch = BatchCompletionRequest(
@@ -200,47 +341,115 @@ class Mistral:
             top_p=payload.get("top_p"),
             max_tokens=payload.get("max_tokens"),
             temperature=payload.get("temperature"),
+            stop_strings=payload.get("stop_strings"),
         )
         return self.batch_completion(batch)[0]
 
+    def _render_prompt_uncached(self, messages_key: tuple) -> str:
+        """
+        Apply the chat template to a conversation, returning the prompt text.
+
+        `messages_key` is the hashable form produced by `_messages_key`, so repeated
+        conversations (e.g. the same system prompt and evidence) skip the template
+        render entirely via the per-instance `_render_prompt` cache.
+        """
+        messages = [{"role": role, "content": content} for role, content in messages_key]
+        return self.tokenizer.apply_chat_template(
+            messages,
+            # tools=[],
+            tokenize=False,
+            add_generation_prompt=True,
+        )
+
+    def _prefill_shared_prefix(self, input_ids: torch.Tensor, attention_mask: torch.Tensor):
+        """
+        Prefill the longest token prefix shared by every prompt in the batch once.
+
+        Takes the left-padded CPU batch and returns `(input_ids, attention_mask,
+        past_key_values)`. When the batch shares at least PREFIX_SHARE_MIN_TOKENS
+        leading tokens, the prefix KV cache is computed with a single forward pass
+        and repeated for every row, and the rows are re-laid out as
+        `prefix + padding + suffix` so the cached columns line up. Otherwise the
+        inputs are returned unchanged with no cache.
+        """
+        rows = [ids[mask.bool()] for ids, mask in zip(input_ids, attention_mask)]
+        if len(rows) < 2:
+            return input_ids, attention_mask, None
+
+        # Keep at least one uncached token per row for generate() to prefill
+        prefix_len = min(len(r) for r in rows) - 1
+        for r in rows[1:]:
+            mismatch = (r[:prefix_len] != rows[0][:prefix_len]).nonzero()
+            if len(mismatch):
+                prefix_len = int(mismatch[0])
+        if prefix_len < PREFIX_SHARE_MIN_TOKENS:
+            return input_ids, attention_mask, None
+
+        with torch.inference_mode():
+            prefix = rows[0][:prefix_len].unsqueeze(0).to(self._input_device)
+            # Base decoder only: the LM head would materialize (prefix_len x vocab) logits
+            past_key_values = self.model.model(input_ids=prefix, use_cache=True).past_key_values
+        past_key_values.batch_repeat_interleave(len(rows))
+
+        # Padding goes between the shared prefix and each suffix; position ids are
+        # derived from the attention mask, so every suffix still continues at prefix_len
+        suffix_width = max(len(r) for r in rows) - prefix_len
+        shared_ids = torch.full(
+            (len(rows), prefix_len + suffix_width), self.tokenizer.pad_token_id, dtype=input_ids.dtype
+        )
+        shared_mask = torch.zeros_like(shared_ids, dtype=attention_mask.dtype)
+        for i, r in enumerate(rows):
+            shared_ids[i, :prefix_len] = r[:prefix_len]
+            shared_ids[i, -(len(r) - prefix_len):] = r[prefix_len:]
+            shared_mask[i, :prefix_len] = 1
+            shared_mask[i, -(len(r) - prefix_len):] = 1
+        return shared_ids, shared_mask, past_key_values
+
+    @staticmethod
+    def _messages_key(messages: List[Message]) -> tuple:
+        return tuple((m["role"], m["content"]) for m in messages)
+
     def batch_completion(self, payload: BatchCompletionRequest) -> List[str]:
-        encoded = [
-            self.tokenizer.apply_chat_template(
-                c,
-                # tools=[],
-                add_generation_prompt=True,
-                return_dict=True,
-                return_tensors="pt",
+        prompts = [self._render_prompt(self._messages_key(c)) for c in payload["conversations"]]
+        # One batched call into the fast tokenizer, left-padded to the longest prompt.
+        # The rendered template already contains the BOS token.
+        assert self.tokenizer.padding_side == "left", "batched generation requires left padding"
+        encoded = self.tokenizer(
+            prompts,
+            add_special_tokens=False,
+            padding=True,
+            return_tensors="pt",
+        )
+        if self.compiled:
+            padded_ids, padded_masks, past_key_values = encoded["input_ids"], encoded["attention_mask"], None
+        else:
+            padded_ids, padded_masks, past_key_values = self._prefill_shared_prefix(
+                encoded["input_ids"], encoded["attention_mask"]
             )
-             for c in payload["conversations"]]
-        ids = [e["input_ids"].squeeze(0) for e in encoded]
-        masks = [e["attention_mask"].squeeze(0) for e in encoded]
-        padded_ids = pad_sequence(ids, batch_first=True, padding_value=self.tokenizer.pad_token_id)
-        padded_masks = pad_sequence(masks, batch_first=True, padding_value=0)
-        padded_ids = padded_ids.to(self.model.device)
-        padded_masks = padded_masks.to(self.model.device)
+        # Pinned host copies let the H2D transfers run asynchronously on the default
+        # stream, which generate() also uses, so they stay ordered before the prefill
+        padded_ids = padded_ids.pin_memory().to(self._input_device, non_blocking=True)
+        padded_masks = padded_masks.pin_memory().to(self._input_device, non_blocking=True)
 
         top_p = payload.get("top_p", self.default_top_p)
         temperature = payload.get("temperature", self.default_temperature)
         max_tokens = payload.get("max_tokens") or self._compute_max_new_tokens(padded_ids.size(1))
 
-        outputs = self._batch_generate(padded_ids, padded_masks, max_tokens, top_p, temperature)
-
-        def _extract_response(text: str) -> str:
-            bos_token_text = self.tokenizer.decode(self.tokenizer.bos_token_id, skip_special_tokens=False)
-            eos_token_text = self.tokenizer.decode(self.tokenizer.eos_token_id, skip_special_tokens=False)
-            pad_token_text = self.tokenizer.decode(self.tokenizer.pad_token_id, skip_special_tokens=False)
-            
-            text = text.strip()
-            text = re.sub(re.escape(bos_token_text), "", text)
-            text = re.sub(re.escape(eos_token_text), "", text)
-            text = re.sub(re.escape(pad_token_text), "", text)
-            response = text.split("[/INST]")[-1].strip()
-            return response
-
-        # I encountered a bug where if skip_special_tokens=True is used, it omitted the [INST] token.
-        # so I simply implemented _extract_response manually.
-        return [
-            _extract_response(self.tokenizer.decode(o, skip_special_tokens=False)) for o in outputs
-        ]
+        outputs = self._batch_generate(
+            padded_ids, padded_masks, max_tokens, top_p, temperature,
+            # Optional early stop (besides EOS) so short answers don't decode up to max_tokens
+            payload.get("stop_strings"),
+            past_key_values,
+        )
+
+        # Every row is padded to the same prompt width, so the generated tokens
+        # start at the same column for the whole batch. Decoding only those skips
+        # re-decoding the (already known) prompt.
+        generated = outputs[:, padded_ids.size(1):]
 
+        # Decoding the full sequence with skip_special_tokens=True dropped the [INST]
+        # markers needed to find the response; the generated tail has none, so the
+        # EOS/pad tokens can simply be skipped here.
+        texts = self.tokenizer.batch_decode(generated, skip_special_tokens=True)
+        self._maybe_empty_cache()
+        return [t.strip() for t in texts]
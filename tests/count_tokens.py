@@ -6,6 +6,7 @@ from transformers import AutoTokenizer
 from src.mistral import MODEL_ID
 
 tokenizer = AutoTokenizer.from_pretrained(MODEL_ID)
+token_texts = {}  # token id -> decoded text, reused across prompts
 while True:
     prompt = prompt_toolkit.prompt("Enter a word or phrase, or type '!quit' to quit: ").strip()
 
@@ -13,10 +14,7 @@ while True:
         print("Goodbye!")
         exit()
 
-    tokens = tokenizer.encode(prompt, return_tensors='pt').squeeze().tolist()
-
-    while tokens[0] == tokenizer.bos_token_id:
-        tokens = tokens[1:]  # Remove the BOS token
+    tokens = tokenizer(prompt, add_special_tokens=False)["input_ids"]  # No BOS token
 
     print(tokens)
 
@@ -27,7 +25,9 @@ while True:
             color = "blue"
         else:
             color = "magenta"
-        print(colored(tokenizer.decode([token]).replace(" ","_"), color), end="")
+        if token not in token_texts:
+            token_texts[token] = tokenizer.decode([token]).replace(" ","_")
+        print(colored(token_texts[token], color), end="")
     print("")
         
 